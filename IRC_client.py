@@ -4,7 +4,7 @@
 #from irclib import nm_to_n, nm_to_h, nm_to_uh, irc_lower
 import threading, sys, logging, Queue, time
 import ircclient as irclib
-from ircclient import nm_to_n, nm_to_h, nm_to_uh, irc_lower
+from ircclient import nm_to_n, nm_to_uh, irc_lower
 
 class IRC_users:
 	def __init__(self, settings):
@@ -1,7 +1,34 @@
-import sys, struct, threading, socket, random, time, string, os, os.path, math, copy, logging, Queue, re, TruckToName, hashlib
+import struct, threading, socket, time, math, logging, Queue, re, TruckToName, hashlib
 import pickle # needed for recording
 from RoRnet import *
 
+# Every RoRnet message starts with this header: command, source, streamid, size
+# The source is signed, the server sends -1 for its own messages.
+_HEADER_STRUCT = struct.Struct('<IiII')
+
+# Character position as we send it: command, position, rotation, animation mode, animation time
+# (the pad byte keeps the 292 byte size that the native layout used to have)
+_CHARACTER_STREAM_STRUCT = struct.Struct('<i7f255sxf')
+
+# Private chat message: target uid, text
+_PRIVCHAT_STRUCT = struct.Struct('<I8000s')
+
+# Initial size of the buffer that outgoing messages are packed in
+_SEND_BUFFER_SIZE = 4096
+
+# Initial size of the buffer that incoming messages are received in
+_RECEIVE_BUFFER_SIZE = 65536
+
+# Messages that the client doesn't handle (yet). These are dropped by the
+# receive thread, before their content is copied or a packet is queued.
+_IGNORED_COMMANDS = frozenset([MSG2_STREAM_UNREGISTER])
+
+# Messages that arrive too often to log every one of them
+_QUIET_COMMANDS = frozenset([MSG2_STREAM_DATA, MSG2_UTF_CHAT, MSG2_NETQUALITY])
+
+# Kernel send and receive buffer size requested for the game connection
+_SOCKET_BUFFER_SIZE = 1 << 20
+
 COLOUR_BLACK    = "#000000"
 COLOUR_GREY     = "#999999"
 COLOUR_RED      = "#FF0000"
@@ -48,10 +75,17 @@ playerColours = [
 	"#999900"
 ];
 
+# Used by getTruckName to strip the UID and the extension from a truck filename
+_truckFilenameReg = re.compile(r'''([a-z0-9]*\-)?((.*)UID\-)?(.*)\.(truck|car|load|airplane|boat|trailer|train|fixed)''')
+
+# game.message() calls in game commands, and the fake chat messages that are sent with them
+_gameMessageReg = re.compile(r'game\.message\(["\']([^"\n]+)["\'], ["\']([a-zA-Z0-9:\._]+)["\'], ([0-9\.f]+), ([a-z]+)\)', flags=(re.MULTILINE | re.DOTALL))
+_fakeChatReg = re.compile(r'#[0-9A-Fa-f]{6}([^#]+)#[0-9A-Fa-f]{6}: (.+)')
+
 def getTruckName(filename):
 	if filename in TruckToName.list:
 		return TruckToName.list[filename]
-	return re.sub(r'''([a-z0-9]*\-)?((.*)UID\-)?(.*)\.(truck|car|load|airplane|boat|trailer|train|fixed)''', r'''\4''', filename.lower())
+	return _truckFilenameReg.sub(r'''\4''', filename.lower())
 
 def getTruckType(filename):
 	return filename.split('.').pop().lower()
@@ -545,112 +579,69 @@ class RoR_Connection:
 		self.sm = streamManager
 		self.runCondition = 1
 		self.streamID = 10 # streamnumbers under 10 are reserved for other stuff
-		self.headersize = struct.calcsize('IIII')
+		self.headersize = _HEADER_STRUCT.size
 		self.uid = 0
 		self.receivedMessages = Queue.Queue()
 		self.netQuality = 0
 		self.connectTime = 0
+		self.sendBuffer = bytearray(_SEND_BUFFER_SIZE)
+		self.receiveThread = None
+		self.sendLock = threading.Lock()
 	
 	def isConnected(self):
 		return (self.socket != None)
 	
+	# Internal use only!
+	# Receives exactly size bytes, or returns None if the connection is closed before that
+	def __recvExactly(self, sock, size):
+		buf = bytearray(size)
+		view = memoryview(buf)
+		received = 0
+		while received < size:
+			count = sock.recv_into(view[received:])
+			if not count:
+				return None
+			received += count
+		return str(buf)
+
 	# Knock, knock - Who's there? - The Master Server! - Really? - No, but we pretend to be one :)
 	# Useful to check if a server is online and to get the protocol version of the server.
 	def knockServer(self, host, port):
+		# create_connection() applies the timeout to the connect as well as to
+		# every recv below, so a server that accepts but never answers can't hang us
 		try:
-			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock = socket.create_connection((u"%s" % host, port), 2)
 		except socket.error, msg:
-			sock = None
-			#print("Couldn't create socket.")
-			return None
-			
-		sock.settimeout(2)
-
-		try:
-			sock.connect((u"%s" % host, port))
-		except socket.error, msg:
-			sock.close()
-			sock = None
 			#print("Couldn't connect to server %s:%d" % (host, port))
 			return None
-		
-		if sock is None:
-			return None
 
-		# send hello
-		data = "MasterServer"
 		try:
-			sock.send(struct.pack('IIII'+str(len(data))+'s', MSG2_HELLO, 5000, 0, len(data), str(data)))
-		except Exception, e:
-			#print('sendMsg error: '+str(e))
-			return None
-		
+			# send hello
+			data = "MasterServer"
+			sock.sendall(_HEADER_STRUCT.pack(MSG2_HELLO, 5000, 0, len(data)) + data)
 
-		# receive answer
-		data = ""
-		tmp = ""
-		errorCount = 0
-		try:
-			while len(data)<self.headersize:
-				try:
-					tmp = sock.recv(self.headersize-len(data))
-				except socket.timeout:
-					continue
-				
-				# unfortunately, we have to do some stupid stuff here, to avoid infinite loops...
-				if not tmp:
-					errorCount += 1;
-					if errorCount > 3:
-						# lost connection
-						#print("Connection error #ERROR_CON005")
-						break
-					continue
-				else:
-					data += tmp
-		
-			if not data or errorCount > 3:
+			# receive answer
+			data = self.__recvExactly(sock, self.headersize)
+			if data is None:
 				# lost connection
 				#print("Connection error #ERROR_CON008")
-				sock.close()
-				sock = None
 				return None
-		
-			(command, source, streamid, size) = struct.unpack('IIII', data)
 
-			data = ""
-			tmp = ""
-			while len(data)<size:
-				try:
-					tmp = sock.recv(size-len(data))
-				except socket.timeout:
-					continue
-				
-				# unfortunately, we have to do some stupid stuff here, to avoid infinite loops...
-				if not tmp:
-					errorCount += 1;
-					if errorCount > 3:
-						# lost connection
-						self.logger.error("Connection error #ERROR_CON006")
-						break
-					continue
-				else:
-					data += tmp
+			(command, source, streamid, size) = _HEADER_STRUCT.unpack(data)
+
+			data = self.__recvExactly(sock, size)
+			if data is None:
+				# lost connection
+				#print("Connection error #ERROR_CON007")
+				return None
 		except socket.error:
+			# socket.timeout is a socket.error as well
 			#print("Connection error #ERROR_CON015")
-			sock.close()
-			sock = None
 			return None
-
-		if not data or errorCount > 3:
-			# lost connection
-			#print("Connection error #ERROR_CON007")
+		finally:
 			sock.close()
-			sock = None
-			return None;
-	
-		content = struct.unpack(str(size) + 's', data)[0]
 
-		return DataPacket(command, source, streamid, size, content)
+		return DataPacket(command, source, streamid, size, data)
 
 	def connect(self, user, serverinfo):
 		# empty queue
@@ -679,6 +670,16 @@ class RoR_Connection:
 			self.socket = None
 			self.logger.error("Couldn't create socket.")
 			return False
+
+		# The protocol is made of small messages (chat, commands, 16-byte headers),
+		# so don't let Nagle hold them back. The buffers have to be set before
+		# connecting for the kernel to take them into account for the TCP window.
+		try:
+			self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER_SIZE)
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER_SIZE)
+		except socket.error, msg:
+			self.logger.warning("Couldn't set socket options: %s", msg)
 						
 		try:
 			self.socket.connect((u"%s" % self.serverinfo.host, self.serverinfo.port))
@@ -688,9 +689,9 @@ class RoR_Connection:
 			self.logger.error("Couldn't connect to server %s:%d", self.serverinfo.host, self.serverinfo.port)
 			return False
 
-		receiveThread = threading.Thread(target=self.__start_receive_thread)
-		receiveThread.setDaemon(True)
-		receiveThread.start()
+		self.receiveThread = threading.Thread(target=self.__start_receive_thread)
+		self.receiveThread.setDaemon(True)
+		self.receiveThread.start()
 
 		# send hello
 		self.logger.debug("Successfully connected! Sending hello message.")
@@ -750,20 +751,23 @@ class RoR_Connection:
 		#	return False
 			
 		# register character stream
-		s = stream_info_t()
-		s.name = "default"
-		s.type = TYPE_CHARACTER
-		s.status = 0
-		s.regdata = chr(2)
-		print "stream default: %d" % self.registerStream(s)
+		character = stream_info_t()
+		character.name = "default"
+		character.type = TYPE_CHARACTER
+		character.status = 0
+		character.regdata = chr(2)
 		
 		# register chat stream
-		s = stream_info_t()
-		s.name = "chat"
-		s.type = TYPE_CHAT
-		s.status = 0
-		s.regdata = 0
-		print "stream chat: %d" % self.registerStream(s)
+		chat = stream_info_t()
+		chat.name = "chat"
+		chat.type = TYPE_CHAT
+		chat.status = 0
+		chat.regdata = 0
+
+		# both registrations go out in one write
+		(characterStreamID, chatStreamID) = self.registerStreams([character, chat])
+		print "stream default: %d" % characterStreamID
+		print "stream chat: %d" % chatStreamID
 		
 		# set the time when we connected (needed to send stream data)
 		self.connectTime = time.time()
@@ -776,23 +780,30 @@ class RoR_Connection:
 	def disconnect(self):
 		self.logger.info("Disconnecting...")
 		self.runCondition = 0
-		time.sleep(5)
 		if not self.socket is None:
 			self.__sendUserLeave()
 			print 'closing socket'
+			# wake up the receive thread, instead of waiting for its recv to time out
+			try:
+				self.socket.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			if not self.receiveThread is None:
+				self.receiveThread.join(5)
 			self.socket.close()
 		self.socket = None
+		self.receiveThread = None
 	
 	# Internal use only!
 	def __sendUserInfo(self, user):
-		data = struct.pack('Iiii40s40s40s10s10s25s40s10s128s',
+		data = USER_INFO_STRUCT.pack(
 			int(user.uniqueID),
 			int(user.authstatus),
 			int(user.slotnum),
 			int(user.colournum),
 			user.username,
-			string.upper(hashlib.sha1(user.usertoken).hexdigest()),
-			string.upper(hashlib.sha1(user.serverpassword).hexdigest()),
+			hashlib.sha1(user.usertoken).hexdigest().upper(),
+			hashlib.sha1(user.serverpassword).hexdigest().upper(),
 			str(user.language),
 			str(user.clientname),
 			str(user.clientversion),
@@ -814,22 +825,32 @@ class RoR_Connection:
 	#  pre: A connection to the server has been established
 	# post: The stream has been registered with the server and with the streammanager
 	def registerStream(self, s):
-		s.origin_sourceid = self.uid
-		s.origin_streamid = self.streamID
-		s.time = -1
-		if s.type==TYPE_TRUCK:
-			data = struct.pack('4i128s2i60s60s', s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.bufferSize, s.time, s.skin, s.sectionConfig)
-		else:
-			data = struct.pack('iiii128s128s', s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, str(s.regdata))
-		self.sendMsg(DataPacket(MSG2_STREAM_REGISTER, s.origin_sourceid, s.origin_streamid, len(data), data))
-		self.sm.addStream(s)
-		self.streamID += 1	
-		return s.origin_streamid
+		return self.registerStreams([s])[0]
+
+	#  pre: A connection to the server has been established
+	# post: The streams have been registered with the server (in a single write) and with the streammanager
+	def registerStreams(self, streams):
+		packets = []
+		streamIDs = []
+		for s in streams:
+			s.origin_sourceid = self.uid
+			s.origin_streamid = self.streamID
+			s.time = -1
+			if s.type==TYPE_TRUCK:
+				data = TRUCK_REGISTER_STRUCT.pack(s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.bufferSize, s.time, s.skin, s.sectionConfig)
+			else:
+				data = STREAM_REGISTER_STRUCT.pack(s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, str(s.regdata))
+			packets.append(DataPacket(MSG2_STREAM_REGISTER, s.origin_sourceid, s.origin_streamid, len(data), data))
+			self.sm.addStream(s)
+			streamIDs.append(s.origin_streamid)
+			self.streamID += 1
+		self.sendMsgs(packets)
+		return streamIDs
 
 	#  pre: A stream has been registered
 	# post: The stream is no longer registered
 	def unregisterStream(self, streamID):
-		data = struct.pack('i', streamID)
+		data = INT_STRUCT.pack(streamID)
 		# MSG2_STREAM_UNREGISTER is not supported by the current RoRnet protocol
 		# self.sendMsg(DataPacket(MSG2_STREAM_UNREGISTER, self.uid, self.streamID, len(data), data))
 		self.sm.delStream(self.uid, streamID)
@@ -838,14 +859,14 @@ class RoR_Connection:
 	# post: A positive/negative reply has been sent back
 	def replyToStreamRegister(self, data, status):
 		# TODO: Is this correct, according to the RoRnet_2.3 specifications?
-		data_out = struct.pack('iiii128s128s', data.type, status, data.origin_sourceid, data.origin_streamid, data.name, data.regdata)
+		data_out = STREAM_REGISTER_STRUCT.pack(data.type, status, data.origin_sourceid, data.origin_streamid, data.name, data.regdata)
 		self.sendMsg(DataPacket(MSG2_STREAM_REGISTER_RESULT, self.uid, data.origin_streamid, len(data_out), data_out))
 	
 	#  pre: A character stream has been registered
 	# post: The data is sent
 	def streamCharacter(self, pos, rot, animMode, animTime):
 		# pack: command, posx, posy, posz, rotx, roty, rotz, rotw, animationMode[255], animationTime
-		data = struct.pack('i7f255sf', CHARACTER_CMD_POSITION, pos.x, pos.y, pos.z, rot.x, rot.y, rot.z, rot.w, animMode, animTime)
+		data = _CHARACTER_STREAM_STRUCT.pack(CHARACTER_CMD_POSITION, pos.x, pos.y, pos.z, rot.x, rot.y, rot.z, rot.w, animMode, animTime)
 		self.sendMsg(DataPacket(MSG2_STREAM_DATA, self.uid, self.sm.getCharSID(self.uid), len(data), data))
 	
 	#  pre: A truck stream has been registered
@@ -855,7 +876,7 @@ class RoR_Connection:
 			theTime = math.floor((time.time()-self.connectTime)*1000)
 		else:
 			theTime = s.time
-		data = struct.pack('=IfffIfffIfff{0}s'.format(len(s.node_data)), theTime, s.engine_speed, s.engine_force, s.engine_clutch, s.engine_gear, s.hydrodirstate, s.brake, s.wheelspeed, s.flagmask, s.refpos.x, s.refpos.y, s.refpos.z, s.node_data)
+		data = TRUCK_STREAM_STRUCT.pack(theTime, s.engine_speed, s.engine_force, s.engine_clutch, s.engine_gear, s.hydrodirstate, s.brake, s.wheelspeed, s.flagmask, s.refpos.x, s.refpos.y, s.refpos.z) + s.node_data
 		self.sendMsg(DataPacket(MSG2_STREAM_DATA, self.uid, streamID, len(data), data))
 
 	#  pre: A character stream has been registered
@@ -901,15 +922,17 @@ class RoR_Connection:
 		maxsize = 100
 		if len(msg) > maxsize:
 			self.logger.debug("%d=len(msg)>maxsize=%d", len(msg), maxsize)
+			chatSID = self.sm.getChatSID(self.uid)
+			packets = []
 			for i in range(0, int(math.ceil(float(len(msg)) / float(maxsize)))):
 				if i == 0:
 					msga = msg[maxsize*i:maxsize*(i+1)]
-					self.logger.debug("sending %s", msga)
-					self.sendMsg(DataPacket(MSG2_UTF_CHAT, self.uid, self.sm.getChatSID(self.uid), len(msga), unicode(msga, errors='ignore').encode('utf-8')))
 				else:
 					msga = "| "+msg[maxsize*i:maxsize*(i+1)]
-					self.logger.debug("sending %s", msga)
-					self.sendMsg(DataPacket(MSG2_UTF_CHAT, self.uid, self.sm.getChatSID(self.uid), len(msga), unicode(msga, errors='ignore').encode('utf-8')))
+				self.logger.debug("sending %s", msga)
+				packets.append(DataPacket(MSG2_UTF_CHAT, self.uid, chatSID, len(msga), unicode(msga, errors='ignore').encode('utf-8')))
+			# all the chunks go out in a single write
+			self.sendMsgs(packets)
 		else:
 			self.sendMsg(DataPacket(MSG2_UTF_CHAT, self.uid, self.sm.getChatSID(self.uid), len(msg), unicode(msg, errors='ignore').encode('utf-8')))
 		self.logger.debug("msg sent: %s", msg)
@@ -924,7 +947,7 @@ class RoR_Connection:
 			return False
 
 		print "sending PRIVCHAT message"
-		data = struct.pack("I8000s", uid, unicode(msg, errors='replace').encode('utf-8'))
+		data = _PRIVCHAT_STRUCT.pack(uid, unicode(msg, errors='replace').encode('utf-8'))
 		self.sendMsg(DataPacket(MSG2_UTF_PRIVCHAT, self.uid, self.sm.getChatSID(self.uid), len(data), data))
 		
 		return True
@@ -971,7 +994,8 @@ class RoR_Connection:
 			if data is None:
 				return
 			
-			self.socket.send(data)
+			# send() may only write a part of the message, sendall() writes it all at once
+			self.socket.sendall(data)
 		except Exception, e:
 			self.logger.exception('sendMsg error: '+str(e))
 			self.runCondition = 0
@@ -980,21 +1004,38 @@ class RoR_Connection:
 		return True
 
 	# Internal use only!
-	def __packPacket(self, packet):
-		if packet.size == 0:
-			# just header
-			data = struct.pack('IIII', packet.command, packet.source, packet.streamid, packet.size)
-		else:
-			data = struct.pack('IIII'+str(packet.size)+'s', packet.command, packet.source, packet.streamid, packet.size, str(packet.data))
-		return data
+	# Packs the message into the send buffer at offset and returns where it ends.
+	# The buffer is shared, so hold sendLock until it has been sent.
+	def __packPacket(self, packet, offset=0):
+		end = offset + self.headersize + packet.size
+		if end > len(self.sendBuffer):
+			newBuffer = bytearray(max(end, 2*len(self.sendBuffer)))
+			newBuffer[0:offset] = self.sendBuffer[0:offset]
+			self.sendBuffer = newBuffer
+		_HEADER_STRUCT.pack_into(self.sendBuffer, offset, packet.command, packet.source, packet.streamid, packet.size)
+		if packet.size > 0:
+			content = str(packet.data)
+			if len(content) != packet.size:
+				# same semantics as a 'Ns' field: truncate or pad with NULs
+				content = content[:packet.size].ljust(packet.size, '\0')
+			self.sendBuffer[offset+self.headersize:end] = content
+		return end
 		
 	def sendMsg(self, packet):
+		return self.sendMsgs((packet,))
+
+	# Sends all the messages with a single write
+	def sendMsgs(self, packets):
 		if self.socket is None:
 			return False
-		if(packet.command!=MSG2_STREAM_DATA):
-			self.logger.debug("S>| %-18s %03d:%02d (%d)" % (commandName(packet.command), packet.source, packet.streamid, packet.size))
-		#print "S>| %-18s %03d:%02d (%d)" % (commandName(packet.command), packet.source, packet.streamid, packet.size)
-		self.__sendRaw(self.__packPacket(packet))
+		with self.sendLock:
+			end = 0
+			for packet in packets:
+				if packet.command!=MSG2_STREAM_DATA and self.logger.isEnabledFor(logging.DEBUG):
+					self.logger.debug("S>| %-18s %03d:%02d (%d)", commandName(packet.command), packet.source, packet.streamid, packet.size)
+				#print "S>| %-18s %03d:%02d (%d)" % (commandName(packet.command), packet.source, packet.streamid, packet.size)
+				end = self.__packPacket(packet, end)
+			self.__sendRaw(memoryview(self.sendBuffer)[:end])
 		
 		return True
 
@@ -1003,6 +1044,20 @@ class RoR_Connection:
 			return self.receivedMessages.get(True, timeout)
 		except Queue.Empty:
 			return None
+
+	# Waits for a message like receiveMsg, but also returns the messages that are
+	# queued behind it (up to maxCount), so a burst is handled in one go.
+	def receiveMsgs(self, timeout=0.5, maxCount=64):
+		packet = self.receiveMsg(timeout)
+		if packet is None:
+			return []
+		packets = [packet]
+		try:
+			while len(packets) < maxCount:
+				packets.append(self.receivedMessages.get_nowait())
+		except Queue.Empty:
+			pass
+		return packets
 	
 	def __start_receive_thread(self):
 		# We need a socket to receive...
@@ -1012,77 +1067,71 @@ class RoR_Connection:
 		
 		self.socket.settimeout(5)
 		
+		# The socket writes straight into this buffer and the messages are parsed in place.
+		# 'start' is the first byte that wasn't processed yet, 'end' the first free byte.
+		buf = bytearray(_RECEIVE_BUFFER_SIZE)
+		view = memoryview(buf)
+		start = 0
+		end = 0
+		# looked up once, they're used several times per message
+		headersize = self.headersize
+		unpackHeader = _HEADER_STRUCT.unpack_from
+		
 		while self.runCondition:
-			# get the header	
-			data = ""
-			tmp = ""
-			errorCount = 0
 			try:
-				while len(data)<self.headersize and self.runCondition:
-					try:
-						tmp = self.socket.recv(self.headersize-len(data))
-					except socket.timeout:
-						continue
-					
-					# unfortunately, we have to do some stupid stuff here, to avoid infinite loops...
-					if not tmp:
-						errorCount += 1;
-						if errorCount > 3:
-							# lost connection
-							self.logger.error("Connection error #ERROR_CON005")
-							self.runCondition = 0
-							break
-						continue
-					else:
-						data += tmp
-			
-				if not data or errorCount > 3:
-					# lost connection
-					self.logger.error("Connection error #ERROR_CON008")
-					self.runCondition = 0
-					break
-			
-				(command, source, streamid, size) = struct.unpack('IIII', data)
-				if(source & 0x80000000):
-					source = -0x100000000 + source
-
-				data = ""
-				tmp = ""
-				while len(data)<size and self.runCondition:
-					try:
-						tmp = self.socket.recv(size-len(data))
-					except socket.timeout:
-						continue
-					
-					# unfortunately, we have to do some stupid stuff here, to avoid infinite loops...
-					if not tmp:
-						errorCount += 1;
-						if errorCount > 3:
-							# lost connection
-							self.logger.error("Connection error #ERROR_CON006")
-							self.runCondition = 0
-							break
-						continue
-					else:
-						data += tmp
+				received = self.socket.recv_into(view[end:])
+			except socket.timeout:
+				continue
 			except socket.error:
-				self.logger.error("Connection error #ERROR_CON015")
+				# no error if we're disconnecting ourselves
+				if self.runCondition:
+					self.logger.error("Connection error #ERROR_CON015")
+				self.runCondition = 0
+				break
+			
+			if not received:
+				# lost connection
+				if self.runCondition:
+					self.logger.error("Connection error #ERROR_CON005")
 				self.runCondition = 0
 				break
+			end += received
+			
+			# process all complete messages that we have
+			while end-start >= headersize:
+				(command, source, streamid, size) = unpackHeader(buf, start)
+				if end-start < headersize+size:
+					break
+				if command in _IGNORED_COMMANDS:
+					start += headersize+size
+					continue
 
-                        if command != MSG2_STREAM_UNREGISTER: # Prevents bot to leave/rejoin on actor removal. Temporary patch until MSG2_STREAM_UNREGISTER handling is properly implemented
-				if not data or errorCount > 3:
-					# lost connection
-			         	self.logger.error("Connection error #ERROR_CON007")
-				 	self.runCondition = 0
-				 	break
-		
-			content = struct.unpack(str(size) + 's', data)[0]
+				content = view[start+headersize:start+headersize+size].tobytes()
+				start += headersize+size
 
-			if not command in [MSG2_STREAM_DATA, MSG2_UTF_CHAT, MSG2_NETQUALITY]:
-				self.logger.debug("R<| %-18s %03d:%02d (%d)" % (commandName(command), source, streamid, size))
+				if not command in _QUIET_COMMANDS and self.logger.isEnabledFor(logging.DEBUG):
+					self.logger.debug("R<| %-18s %03d:%02d (%d)", commandName(command), source, streamid, size)
 
-			self.receivedMessages.put(DataPacket(command, source, streamid, size, content))
+				self.receivedMessages.put(DataPacket(command, source, streamid, size, content))
+			
+			if start == end:
+				start = end = 0
+			elif end == len(buf) or start >= len(buf)/2:
+				# move the incomplete message to the front of the buffer
+				if end-start >= headersize:
+					needed = headersize + unpackHeader(buf, start)[3]
+				else:
+					needed = headersize
+				if needed > len(buf):
+					# this message doesn't fit, use a bigger buffer
+					newbuf = bytearray(max(needed, 2*len(buf)))
+					newbuf[0:end-start] = buf[start:end]
+					buf = newbuf
+					view = memoryview(buf)
+				else:
+					buf[0:end-start] = buf[start:end]
+				end -= start
+				start = 0
 		self.logger.warning("Receive thread exiting...")
 	
 	def setNetQuality(self, quality):
@@ -1117,7 +1166,19 @@ class Client(threading.Thread):
 		self.eh = eventHandler(self.sm, self.logger, self.irc, self.server, self.main.settings, self.ID)
 		self.fullShutdown = 0
 		
-		self.intsize = struct.calcsize('i')
+		# processPacket looks up the handler for each received message in here
+		self.packetHandlers = {
+			MSG2_STREAM_DATA:            self.__processStreamData,
+			MSG2_NETQUALITY:             self.__processNetQuality,
+			MSG2_UTF_CHAT:               self.__processChat,
+			MSG2_STREAM_REGISTER:        self.__processStreamRegister,
+			MSG2_USER_JOIN:              self.__processUserJoin,
+			MSG2_USER_INFO:              self.__processUserInfo,
+			MSG2_STREAM_REGISTER_RESULT: self.__processStreamRegisterResult,
+			MSG2_USER_LEAVE:             self.__processUserLeave,
+			MSG2_GAME_CMD:               self.__processGameCmd,
+			MSG2_UTF_PRIVCHAT:           self.__processPrivChat,
+		}
 		
 		threading.Thread.__init__(self)
 		
@@ -1209,11 +1270,11 @@ class Client(threading.Thread):
 				self.irc.sayError("Lost connection to server (#ERROR_CON003)")
 				break
 
-			packet = self.server.receiveMsg(0.03)
-			
-			# if not packet is None:
-			if not packet is None:	
+			for packet in self.server.receiveMsgs(0.03):
 				self.processPacket(packet)
+				if not self.server.runCondition:
+					# the connection went down, don't handle the rest of the batch
+					break
 
 			self.checkQueue()
 			
@@ -1232,116 +1293,115 @@ class Client(threading.Thread):
 	#####################
 	
 	def processPacket(self, packet):
-		if packet.command == MSG2_STREAM_DATA:
-			# Critical performance impact!
-			# uncomment the following line to reduce server load:
-			#return
-			stream = self.sm.getStreamData(packet.source, packet.streamid)
-
-			if(stream.type == TYPE_CHARACTER):
-				streamData = processCharacterData(packet.data)
-				if streamData.command == CHARACTER_CMD_POSITION:
-					self.sm.setPosition(packet.source, packet.streamid, streamData.pos)
-					self.sm.setCurrentStream(packet.source, packet.source, packet.streamid)
-				elif streamData.command == CHARACTER_CMD_ATTACH:
-					self.sm.setCurrentStream(packet.source, streamData.source_id, streamData.stream_id)
-				self.eh.on_stream_data(packet.source, stream, streamData)
-				
-			elif(stream.type==TYPE_TRUCK):
-				streamData = processTruckData(packet.data)
-				self.sm.setPosition(packet.source, packet.streamid, streamData.refpos)
-				self.eh.on_stream_data(packet.source, stream, streamData)
-
-			elif stream == None:
-				self.logger.warning("EEE stream %-4s:%-2s not found!" % (packet.source, packet.streamid))
-		
-		elif packet.command == MSG2_NETQUALITY:
-			quality = processNetQuality(packet.data)
-			if self.server.setNetQuality(quality):
-				self.eh.on_net_quality_change(packet.source, quality)
-			#self.irc.sayDebug("quality: %d" % quality)
-			
-		elif packet.command == MSG2_UTF_CHAT:		
-			if packet.source > 100000:
-				packet.source = -1
-			str_tmp = str(packet.data).decode('utf-8').strip('\0')
-			
-			self.logger.debug("CHAT| " + str_tmp)
-			
-			self.irc.sayChat(str_tmp, packet.source)
-							
-			# ignore chat from ourself
-			if (len(str_tmp) > 0) and (packet.source != self.server.uid):
-				self.eh.on_chat(packet.source, str_tmp)
-
-		elif packet.command == MSG2_STREAM_REGISTER:
-			data = processRegisterStreamData(packet.data)
-			self.sm.addStream(data)
-			res = self.eh.on_stream_register(packet.source, data)
-			
-			if data.type == TYPE_TRUCK:
-				if res != 1:
-					res = -1
-				# send stream register result back
-				self.server.replyToStreamRegister(data, res)
-			
-		elif packet.command == MSG2_USER_JOIN:
-			# self.interpretUserInfo(packet)
-			data = processUserInfo(packet.data)
-			self.sm.addClient(data)	
-			self.irc.sayJoin(packet.source)
-			if packet.source!=self.server.uid:
-				self.eh.on_join(packet.source, data)
-			
-		elif packet.command == MSG2_USER_INFO:
-			# self.interpretUserInfo(packet)
-			data = processUserInfo(packet.data)
-			self.sm.addClient(data)	
-			if packet.source!=self.server.uid:
-				self.eh.on_join(packet.source, data)
-			
-		elif packet.command == MSG2_STREAM_REGISTER_RESULT:
-			# self.interpretStreamRegisterResult(packet)
-			self.eh.on_stream_register_result(packet.source, processRegisterStreamData(packet.data))
-		
-		elif packet.command == MSG2_USER_LEAVE:
-			self.irc.sayLeave(packet.source)
-			self.eh.on_leave(packet.source)
-			if packet.source == self.server.uid:
-				# it is us that left...
-				# Not good!
-				self.logger.error("Server closed connection (#ERROR_CON010)")
-				self.server.runCondition = 0
-			self.sm.delClient(packet.source)
-
-		elif packet.command == MSG2_GAME_CMD:
+		handler = self.packetHandlers.get(packet.command)
+		if handler is None:
 			str_tmp = str(packet.data).strip('\0')
-			#self.logger.debug("GAME_CMD| " + str_tmp)
-			
-			#self.irc.sayInfo('(game_cmd) '+str_tmp)
-							
-			# ignore chat from ourself
-			if (len(str_tmp) > 0) and (packet.source != self.server.uid):
-				self.eh.on_game_cmd((int(packet.source) | 0x80000000), str_tmp)
-
-		elif packet.command == MSG2_UTF_PRIVCHAT:
-			str_tmp = str(packet.data).decode('utf-8').strip('\0')
-			self.logger.debug("CHAT| (private) " + str_tmp)
+			self.irc.sayError('Unhandled message (type: %d, from: %d): %s' % (packet.command, packet.source, str_tmp))
+		else:
+			handler(packet)
+
+	def __processStreamData(self, packet):
+		# Critical performance impact!
+		# uncomment the following line to reduce server load:
+		#return
+		stream = self.sm.getStreamData(packet.source, packet.streamid)
+
+		if(stream.type == TYPE_CHARACTER):
+			streamData = processCharacterData(packet.data)
+			if streamData.command == CHARACTER_CMD_POSITION:
+				self.sm.setPosition(packet.source, packet.streamid, streamData.pos)
+				self.sm.setCurrentStream(packet.source, packet.source, packet.streamid)
+			elif streamData.command == CHARACTER_CMD_ATTACH:
+				self.sm.setCurrentStream(packet.source, streamData.source_id, streamData.stream_id)
+			self.eh.on_stream_data(packet.source, stream, streamData)
 			
-			self.irc.sayPrivChat(str_tmp, packet.source)
-							
-			# ignore chat from ourself
-			if (len(str_tmp) > 0) and (packet.source != self.server.uid):
-				self.eh.on_private_chat(packet.source, str_tmp)
-				# self.processCommand(str_tmp, packet)
+		elif(stream.type==TYPE_TRUCK):
+			streamData = processTruckData(packet.data)
+			self.sm.setPosition(packet.source, packet.streamid, streamData.refpos)
+			self.eh.on_stream_data(packet.source, stream, streamData)
 
-                # not implemented yet
-		elif packet.command == MSG2_STREAM_UNREGISTER:
-                        str_tmp = str(packet.data).strip('\0')
+		elif stream == None:
+			self.logger.warning("EEE stream %-4s:%-2s not found!", packet.source, packet.streamid)
+	
+	def __processNetQuality(self, packet):
+		quality = processNetQuality(packet.data)
+		if self.server.setNetQuality(quality):
+			self.eh.on_net_quality_change(packet.source, quality)
+		#self.irc.sayDebug("quality: %d" % quality)
 		
-		else:
-			str_tmp = str(packet.data).strip('\0')
-			self.irc.sayError('Unhandled message (type: %d, from: %d): %s' % (packet.command, packet.source, str_tmp))
+	def __processChat(self, packet):
+		if packet.source > 100000:
+			packet.source = -1
+		str_tmp = packet.data.strip('\0').decode('utf-8', 'replace')
+		
+		self.logger.debug("CHAT| %s", str_tmp)
+		
+		self.irc.sayChat(str_tmp, packet.source)
+						
+		# ignore chat from ourself
+		if (len(str_tmp) > 0) and (packet.source != self.server.uid):
+			self.eh.on_chat(packet.source, str_tmp)
+
+	def __processStreamRegister(self, packet):
+		data = processRegisterStreamData(packet.data)
+		self.sm.addStream(data)
+		res = self.eh.on_stream_register(packet.source, data)
+		
+		if data.type == TYPE_TRUCK:
+			if res != 1:
+				res = -1
+			# send stream register result back
+			self.server.replyToStreamRegister(data, res)
+		
+	def __processUserJoin(self, packet):
+		# self.interpretUserInfo(packet)
+		data = processUserInfo(packet.data)
+		self.sm.addClient(data)	
+		self.irc.sayJoin(packet.source)
+		if packet.source!=self.server.uid:
+			self.eh.on_join(packet.source, data)
+		
+	def __processUserInfo(self, packet):
+		# self.interpretUserInfo(packet)
+		data = processUserInfo(packet.data)
+		self.sm.addClient(data)	
+		if packet.source!=self.server.uid:
+			self.eh.on_join(packet.source, data)
+		
+	def __processStreamRegisterResult(self, packet):
+		# self.interpretStreamRegisterResult(packet)
+		self.eh.on_stream_register_result(packet.source, processRegisterStreamData(packet.data))
+	
+	def __processUserLeave(self, packet):
+		self.irc.sayLeave(packet.source)
+		self.eh.on_leave(packet.source)
+		if packet.source == self.server.uid:
+			# it is us that left...
+			# Not good!
+			self.logger.error("Server closed connection (#ERROR_CON010)")
+			self.server.runCondition = 0
+		self.sm.delClient(packet.source)
+
+	def __processGameCmd(self, packet):
+		str_tmp = str(packet.data).strip('\0')
+		#self.logger.debug("GAME_CMD| " + str_tmp)
+		
+		#self.irc.sayInfo('(game_cmd) '+str_tmp)
+						
+		# ignore chat from ourself
+		if (len(str_tmp) > 0) and (packet.source != self.server.uid):
+			self.eh.on_game_cmd((int(packet.source) | 0x80000000), str_tmp)
+
+	def __processPrivChat(self, packet):
+		str_tmp = packet.data.strip('\0').decode('utf-8', 'replace')
+		self.logger.debug("CHAT| (private) %s", str_tmp)
+		
+		self.irc.sayPrivChat(str_tmp, packet.source)
+						
+		# ignore chat from ourself
+		if (len(str_tmp) > 0) and (packet.source != self.server.uid):
+			self.eh.on_private_chat(packet.source, str_tmp)
+			# self.processCommand(str_tmp, packet)
 
 	def checkQueue(self):
 		while not self.main.RoRqueue[self.ID].empty():
@@ -1716,15 +1776,13 @@ class eventHandler:
 	
 	def on_game_cmd(self, source, cmd):	
 		# print cmd
-		prog = re.compile(r'game\.message\(["\']([^"\n]+)["\'], ["\']([a-zA-Z0-9:\._]+)["\'], ([0-9\.f]+), ([a-z]+)\)', flags=(re.MULTILINE | re.DOTALL))
-		result = prog.findall(cmd)
+		result = _gameMessageReg.findall(cmd)
 		
 		for i in range(0,len(result)):
 			if result[i][1]=="user_comment.png":
 				# this is a fake chat message
 				# User to uid
-				prog2 = re.compile(r'#[0-9A-Fa-f]{6}([^#]+)#[0-9A-Fa-f]{6}: (.+)')
-				res2 = prog2.match(result[i][0])
+				res2 = _fakeChatReg.match(result[i][0])
 				if res2 is None:
 					self.irc.sayChat(result[i][0], source)
 				else:
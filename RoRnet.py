@@ -1,4 +1,4 @@
-import struct, logging, time
+import struct, time
 
 RORNET_VERSION = "RoRnet_2.42"
 
@@ -74,77 +74,93 @@ NETMASK_CLIGHT4     = 2048 #!< custom light 4 on
 NETMASK_POLICEAUDIO = 4096 #!< police siren on
 NETMASK_PARTICLE    = 8192 #!< custom particles on
 
+# Layouts of the RoRnet structures. They are compiled once here and shared by
+# the process* functions below and by the senders in RoR_client.
+# RoRnet is little-endian and packed, hence '<' (no native alignment or padding).
+INT_STRUCT              = struct.Struct('<i')
+NETQUALITY_STRUCT       = struct.Struct('<I')
+USER_INFO_STRUCT        = struct.Struct('<Iiii40s40s40s10s10s25s40s10s128s')
+SERVER_INFO_STRUCT      = struct.Struct('<20s128s128s?4096s')
+STREAM_REGISTER_STRUCT  = struct.Struct('<iiii128s128s')
+TRUCK_REGISTER_STRUCT   = struct.Struct('<4i128s2i60s60s')
+TRUCK_STREAM_STRUCT     = struct.Struct('<IfffIfffIfff') # followed by the node data
+CHARACTER_POS_STRUCT    = struct.Struct('<i5f10s')
+CHARACTER_ATTACH_STRUCT = struct.Struct('<4i')
+
+# MSG2_ value -> its name without the prefix, for commandName
+_COMMAND_NAMES = dict([(value, name[5:]) for (name, value) in globals().items() if name.startswith("MSG2_")])
+
 # helper function to return the variable name
 def commandName(cmd):
-  vars = globals()
-  for c in vars:
-    if vars[c] == cmd and len(c) > 4 and ( c[0:5] == "MSG2_"):
-	  return c[5:]
+	return _COMMAND_NAMES.get(cmd)
 
 def processCharacterAttachData(data):
 	s = charAttach_data_t()
-	s.command, s.source_id, s.stream_id, s.position = struct.unpack('4i', data)
+	s.command, s.source_id, s.stream_id, s.position = CHARACTER_ATTACH_STRUCT.unpack(data)
 	return s
 
 def processCharacterPosData(data):
 	s = charPos_data_t()
-	unpacked = struct.unpack("i5f10s", data)
+	unpacked = CHARACTER_POS_STRUCT.unpack(data)
         s.command, s.pos.x, s.pos.y, s.pos.z = unpacked[:4]
         s.rot.x, s.rot.y, s.rot.z, s.rot.w, s.animationTime, s.animationMode = unpacked[1:]
 	s.animationMode = s.animationMode.strip('\0')
 	return s
 
 def processCharacterData(data):
-	thecommand = struct.unpack('i', data[0:4])[0]
-	if thecommand == CHARACTER_CMD_POSITION:
-		return processCharacterPosData(data)
-	if thecommand == CHARACTER_CMD_ATTACH:
-		return processCharacterAttachData(data)
-	else:
+	thecommand = INT_STRUCT.unpack_from(data)[0]
+	process = _CHARACTER_PROCESSORS.get(thecommand)
+	if process is None:
 		return charPos_data_t()
-				
+	return process(data)
+
+# character stream command -> function that unpacks it
+_CHARACTER_PROCESSORS = {
+	CHARACTER_CMD_POSITION: processCharacterPosData,
+	CHARACTER_CMD_ATTACH:   processCharacterAttachData,
+}
 
 def processTruckData(data):
     s = truckStream_data_t()
-    if len(data) == 48:
-        fmt = '=IfffIfffIfff'
-    elif len(data) > 48:
-        fmt = '=IfffIfffIfff{0}s'.format(len(data) - 48)
-    else:
-        raise ValueError("Malformed truck data. The client should sent at least 48 bytes, not %d", len(data))
-
-    unpacked = struct.unpack(fmt, data)
-    if len(data) == 48:
-        s.time, s.engine_speed, s.engine_force, s.engine_clutch, s.engine_gear, s.hydrodirstate, s.brake, s.wheelspeed, s.flagmask, s.refpos.x, s.refpos.y, s.refpos.z = unpacked
-    else:
-        s.time, s.engine_speed, s.engine_force, s.engine_clutch, s.engine_gear, s.hydrodirstate, s.brake, s.wheelspeed, s.flagmask, s.refpos.x, s.refpos.y, s.refpos.z, s.node_data = unpacked
+    if len(data) < TRUCK_STREAM_STRUCT.size:
+        raise ValueError("Malformed truck data. The client should sent at least %d bytes, not %d" % (TRUCK_STREAM_STRUCT.size, len(data)))
+
+    s.time, s.engine_speed, s.engine_force, s.engine_clutch, s.engine_gear, s.hydrodirstate, s.brake, s.wheelspeed, s.flagmask, s.refpos.x, s.refpos.y, s.refpos.z = TRUCK_STREAM_STRUCT.unpack_from(data)
+    if len(data) > TRUCK_STREAM_STRUCT.size:
+        s.node_data = data[TRUCK_STREAM_STRUCT.size:]
     return s
 	
 def processRegisterStreamData(data):
+	type = INT_STRUCT.unpack_from(data)[0]
+	process = _REGISTER_STREAM_PROCESSORS.get(type)
+	if process is None:
+		return stream_info_t()
+	return process(data)
+
+def processRegisterGenericData(data):
 	s = stream_info_t()
-	type = struct.unpack("i", data[:4])[0]
-	if type == TYPE_CHAT or type == TYPE_CHARACTER:
-	        unpacked = struct.unpack("iiii128s128s", data)
-                s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.regdata = unpacked
-	elif type == TYPE_TRUCK:
-		unpacked = struct.unpack("4i128s2i60s60s", data)
-                s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.bufferSize, s.time, s.skin, s.sectionConfig = unpacked
+	s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.regdata = STREAM_REGISTER_STRUCT.unpack(data)
 	s.name = s.name.strip('\0')
-        s.skin = s.skin.strip("\0")
-        s.sectionConfig = s.sectionConfig.strip("\0")
 	return s
 	
 def processRegisterTruckData(data):
 	s = stream_info_t()
-	s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.bufferSize, s.time, s.skin, s.sectionConfig = struct.unpack('4i128s2i60s60s', data)
+	s.type, s.status, s.origin_sourceid, s.origin_streamid, s.name, s.bufferSize, s.time, s.skin, s.sectionConfig = TRUCK_REGISTER_STRUCT.unpack(data)
 	s.name = s.name.strip('\0')
 	s.skin = s.skin.strip("\0")
 	s.sectionConfig = s.sectionConfig.strip("\0")
 	return s
 
+# stream type -> function that unpacks its registration
+_REGISTER_STREAM_PROCESSORS = {
+	TYPE_TRUCK:     processRegisterTruckData,
+	TYPE_CHARACTER: processRegisterGenericData,
+	TYPE_CHAT:      processRegisterGenericData,
+}
+
 def processUserInfo(data):
 	u = user_info_t()
-	u.uniqueID, u.authstatus, u.slotnum, u.colournum, u.username, u.usertoken, u.serverpassword, u.language, u.clientname, u.clientversion, u.clientGUID, u.sessiontype, u.sessionoptions = struct.unpack('Iiii40s40s40s10s10s25s40s10s128s', data)
+	u.uniqueID, u.authstatus, u.slotnum, u.colournum, u.username, u.usertoken, u.serverpassword, u.language, u.clientname, u.clientversion, u.clientGUID, u.sessiontype, u.sessionoptions = USER_INFO_STRUCT.unpack(data)
 	u.username       = u.username.decode('utf-8').strip('\0')
 	u.usertoken      = u.usertoken.strip('\0')
 	u.serverpassword = u.serverpassword.strip('\0')
@@ -158,7 +174,7 @@ def processUserInfo(data):
 	
 def processServerInfo(data):
 	s = server_info_t()
-	s.protocolversion, s.terrain, s.servername, s.passworded, s.info = struct.unpack('20s128s128s?4096s', data)
+	s.protocolversion, s.terrain, s.servername, s.passworded, s.info = SERVER_INFO_STRUCT.unpack(data)
 	s.protocolversion = s.protocolversion.strip('\0')
 	s.terrain         = s.terrain.strip('\0')
 	s.servername      = s.servername.strip('\0').replace('%20', ' ')
@@ -167,7 +183,7 @@ def processServerInfo(data):
 	
 
 def processNetQuality(data):
-	(quality) = struct.unpack('I', data)
+	(quality,) = NETQUALITY_STRUCT.unpack(data)
 	return quality
 	
 def rawAuthToString(auth):
@@ -216,8 +232,9 @@ class user_info_t:
 		self.slotnum        = -1
 		self.colournum      = -1
 	
+	# only copies the fields of u that are set (that differ from a new user_info_t)
 	def update(self, u):
-		t = user_info_t()
+		t = _DEFAULT_USER_INFO
 		if u.uniqueID != t.uniqueID:
 			self.uniqueID = u.uniqueID
 			
@@ -247,7 +264,9 @@ class user_info_t:
 			
 		if u.colournum != t.colournum:
 			self.colournum = u.colournum
-		del t
+
+# the defaults that user_info_t.update compares against
+_DEFAULT_USER_INFO = user_info_t()
 
 class stream_info_t:
 	def __init__(self):
@@ -317,12 +336,15 @@ class server_info_t:
 		self.password        = ""
 		self.info            = ""
 
+	# only copies the fields of u that are set (that differ from a new server_info_t)
 	def update(self, u):
-		t = server_info_t()
+		t = _DEFAULT_SERVER_INFO
 		if u.terrain != t.terrain:
 			self.terrain = u.terrain
 		if u.servername != t.servername:
 			self.servername = u.servername
 		if u.info != t.info:
 			self.info = u.info
-		del t
+
+# the defaults that server_info_t.update compares against
+_DEFAULT_SERVER_INFO = server_info_t()
@@ -164,6 +164,7 @@ class IRC(object):
 		self.fn_to_add_timeout = fn_to_add_timeout
 		self.connections = []
 		self.handlers = {}
+		self._handler_cache = {}  # event type -> sorted tuple of handlers
 		self.delayed_commands = []  # list of DelayedCommands
 
 		self.add_global_handler("ping", _ping_ponger, -42)
@@ -265,6 +266,7 @@ class IRC(object):
 		if not event in self.handlers:
 			self.handlers[event] = []
 		bisect.insort(self.handlers[event], ((priority, handler)))
+		self._handler_cache.clear()
 
 	def remove_global_handler(self, event, handler):
 		"""Removes a global handler function.
@@ -281,6 +283,7 @@ class IRC(object):
 		for h in self.handlers[event]:
 			if handler == h[1]:
 				self.handlers[event].remove(h)
+		self._handler_cache.clear()
 		return 1
 
 	def execute_at(self, at, function, arguments=()):
@@ -338,8 +341,14 @@ class IRC(object):
 
 	def _handle_event(self, connection, event):
 		"""[Internal]"""
-		h = self.handlers
-		th = sorted(h.get("all_events", []) + h.get(event.eventtype(), []))
+		eventtype = event.eventtype()
+		th = self._handler_cache.get(eventtype)
+		if th is None:
+			# merge "all_events" with the handlers of this event type once,
+			# until the handlers change again
+			h = self.handlers
+			th = tuple(sorted(h.get("all_events", []) + h.get(eventtype, [])))
+			self._handler_cache[eventtype] = th
 		for handler in th:
 			if handler[1](connection, event) == "NO MORE":
 				return
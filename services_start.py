@@ -1,5 +1,8 @@
-import threading, time, Queue, sys, os, logging, copy
-from xml.etree import ElementTree as ET # used to parse xml, for the config file
+import time, Queue, sys, os, logging, logging.handlers, copy
+try:
+	from xml.etree import cElementTree as ET # used to parse xml, for the config file
+except ImportError:
+	from xml.etree import ElementTree as ET
 import IRC_client, RoR_client
 
 """
@@ -43,6 +46,21 @@ import IRC_client, RoR_client
 
 use_irc = True
 
+# Number of log records that are buffered before they're written to the log file
+LOG_BUFFER_CAPACITY = 256
+
+# Maximum number of seconds a buffered log record waits before it's written to the log file
+LOG_FLUSH_INTERVAL = 5
+
+# Maps the level attribute of <logfile> in the configuration to a logging level
+LOG_LEVELS = {
+	'debug': logging.DEBUG,
+	'info': logging.INFO,
+	'warning': logging.WARNING,
+	'error': logging.ERROR,
+	'critical': logging.CRITICAL,
+}
+
 # This program allows you to monitor your servers through IRC.
 # It can connect to 1..1 IRC server and 1..* RoR servers.
 
@@ -180,22 +198,14 @@ class Config:
 			# if an element <logfile> exists in <general>
 			if not element.find("./general/logfile") is None:
 				# if an attribute level exists
-				tmp = element.find("./general/logfile").get("level", default="")
-				if tmp == "debug":
-					self.settings['general']['log_level'] = logging.DEBUG
-				elif tmp == "info":
-					self.settings['general']['log_level'] = logging.INFO
-				elif tmp == "warning":
-					self.settings['general']['log_level'] = logging.WARNING
-				elif tmp == "error":
-					self.settings['general']['log_level'] = logging.ERROR
-				elif tmp == "critical":
-					self.settings['general']['log_level'] = logging.CRITICAL
+				tmp = element.find("./general/logfile").get("level", "")
+				if tmp in LOG_LEVELS:
+					self.settings['general']['log_level'] = LOG_LEVELS[tmp]
 				else:
 					self.logger.warning("Unknown loglevel '%s' in configuration.xml: general/logfile[@level]", tmp)
 			
 				# if an attribute append exists
-				tmp = element.find("./general/logfile").get("append", default="")
+				tmp = element.find("./general/logfile").get("append", "")
 				if tmp == "yes" or tmp == "true" or tmp == "1":
 					self.settings['general']['log_filemode'] = "a"
 				elif tmp == "no" or tmp == "false" or tmp == "0":
@@ -211,14 +221,14 @@ class Config:
 			if not element.find("./general/admins") is None:
 				admins = element.find("./general/admins")
 				for admin in admins:
-					username = admin.get("username", default="")
+					username = admin.get("username", "")
 					if len(username.strip())==0:
 						self.logger.error("Every admin element should have a username attribute!")
 						continue
 					else:
 						self.settings['general']['admins'][username] = { 'username': username }
 
-					tmp = admin.get("password", default="")
+					tmp = admin.get("password", "")
 					if len(tmp.strip())==0:
 						self.logger.error("Admin '%s' should have a password!", username)
 						del self.settings['general']['admins'][username]
@@ -241,7 +251,7 @@ class Config:
 			# if an element <server> exists in <IRCclient>
 			if not element.find("./IRCclient/server") is None:
 				self.settings['IRCclient']['host'] = element.find("IRCclient/server").get("host")
-				self.settings['IRCclient']['port'] = int(element.find("IRCclient/server").get("port", default=self.settings['IRCclient']['port']))
+				self.settings['IRCclient']['port'] = int(element.find("IRCclient/server").get("port", self.settings['IRCclient']['port']))
 			else:
 				self.logger.critical("In configuration.xml: IRCclient/server needs to be set!")
 				sys.exit(1)
@@ -251,25 +261,25 @@ class Config:
 		
 			# if an element <user> exists in <IRCclient>
 			if not element.find("./IRCclient/user") is None:
-				self.settings['IRCclient']['nickname'] = element.find("IRCclient/user").get("nickname", default=self.settings['IRCclient']['nickname'])
-				self.settings['IRCclient']['realname'] = element.find("IRCclient/user").get("realname", default=self.settings['IRCclient']['realname'])	
-				self.settings['IRCclient']['username'] = element.find("IRCclient/user").get("username", default=self.settings['IRCclient']['username'])
-				self.settings['IRCclient']['password'] = element.find("IRCclient/user").get("password", default=self.settings['IRCclient']['password'])		
+				self.settings['IRCclient']['nickname'] = element.find("IRCclient/user").get("nickname", self.settings['IRCclient']['nickname'])
+				self.settings['IRCclient']['realname'] = element.find("IRCclient/user").get("realname", self.settings['IRCclient']['realname'])	
+				self.settings['IRCclient']['username'] = element.find("IRCclient/user").get("username", self.settings['IRCclient']['username'])
+				self.settings['IRCclient']['password'] = element.find("IRCclient/user").get("password", self.settings['IRCclient']['password'])		
 
 			# if an element <oper> exists in <IRCclient>
 			if not element.find("./IRCclient/oper") is None:
-				self.settings['IRCclient']['oper_username'] = element.find("./IRCclient/oper").get("username", default=self.settings['IRCclient']['oper_username'])
-				self.settings['IRCclient']['oper_password'] = element.find("./IRCclient/oper").get("password", default=self.settings['IRCclient']['oper_password'])
+				self.settings['IRCclient']['oper_username'] = element.find("./IRCclient/oper").get("username", self.settings['IRCclient']['oper_username'])
+				self.settings['IRCclient']['oper_password'] = element.find("./IRCclient/oper").get("password", self.settings['IRCclient']['oper_password'])
 
 			# if an element <nickserv> exists in <IRCclient>
 			if not element.find("./IRCclient/nickserv") is None:
-				self.settings['IRCclient']['nickserv_username'] = element.find("./IRCclient/nickserv").get("username", default=self.settings['IRCclient']['nickserv_username'])
-				self.settings['IRCclient']['nickserv_password'] = element.find("./IRCclient/nickserv").get("password", default=self.settings['IRCclient']['nickserv_password'])		
+				self.settings['IRCclient']['nickserv_username'] = element.find("./IRCclient/nickserv").get("username", self.settings['IRCclient']['nickserv_username'])
+				self.settings['IRCclient']['nickserv_password'] = element.find("./IRCclient/nickserv").get("password", self.settings['IRCclient']['nickserv_password'])		
 
 			# if an element <local> exists in <IRCclient>
 			if not element.find("./IRCclient/local") is None:
-				self.settings['IRCclient']['local_address'] = element.find("./IRCclient/local").get("address", default=self.settings['IRCclient']['local_address'])
-				self.settings['IRCclient']['local_port'] = int(element.find("./IRCclient/local").get("port", default=self.settings['IRCclient']['local_port']))
+				self.settings['IRCclient']['local_address'] = element.find("./IRCclient/local").get("address", self.settings['IRCclient']['local_address'])
+				self.settings['IRCclient']['local_port'] = int(element.find("./IRCclient/local").get("port", self.settings['IRCclient']['local_port']))
 
 			# if an element <ssl> exists in <IRCclient>
 			tmp = element.find("./IRCclient/ssl")
@@ -299,7 +309,7 @@ class Config:
 			
 			# search for an element with id="default/template"
 			for RoRclient in RoRclients:
-				if RoRclient.get("id", default="")=="default/template":
+				if RoRclient.get("id", "")=="default/template":
 					self.logger.info("Parsing template-RoRclient 'default/template'")
 					self.parseRoRclient("default/template", RoRclient, defaultRoRclient)
 					break
@@ -312,7 +322,7 @@ class Config:
 				else:
 					ID = "RoR %d" % id
 				
-				if RoRclient.get("id", default="")=="default/template":
+				if RoRclient.get("id", "")=="default/template":
 					continue
 				
 				if not RoRclient.get("enabled") is None:
@@ -351,9 +361,9 @@ class Config:
 
 		# if an element <server> exists
 		if not RoRclient.find("./server") is None:
-			s['host']     = RoRclient.find("./server").get("host", default=s['host'])
-			s['port'] = int(RoRclient.find("./server").get("port", default=s['port']))
-			s['password'] = RoRclient.find("./server").get("password", default=s['password'])
+			s['host']     = RoRclient.find("./server").get("host", s['host'])
+			s['port'] = int(RoRclient.find("./server").get("port", s['port']))
+			s['password'] = RoRclient.find("./server").get("password", s['password'])
 		if ( s['host'] is None or s['port']==0 ) and ID != "default/template":
 			self.logger.error("configuration/RoRclients/RoRclient(%s)/server[@host, @port] needs to be set!", ID)
 			self.logger.error("Ignoring RoRclient(%s)", ID)
@@ -361,7 +371,7 @@ class Config:
 
 		# if an element <irc> exists
 		if not RoRclient.find("./irc") is None:
-			s['ircchannel'] = RoRclient.find("./irc").get("channel", default=s['ircchannel']).lower()
+			s['ircchannel'] = RoRclient.find("./irc").get("channel", s['ircchannel']).lower()
 		if ( RoRclient.find("./irc") is None or s['ircchannel'] is None ) and ID != "default/template":
 			self.logger.error("configuration/RoRclients/RoRclient(%s)/irc[@channel] needs to be set!", ID)
 			self.logger.error("Ignoring RoRclient(%s)", ID)
@@ -369,22 +379,22 @@ class Config:
 	
 		# if an element <user> exists
 		if not RoRclient.find("./user") is None:
-			s['username']     = RoRclient.find("./user").get("name", default=s['username'])
-			s['usertoken']    = RoRclient.find("./user").get("token", default=s['usertoken'])
-			s['userlanguage'] = RoRclient.find("./user").get("language", default=s['userlanguage'])
+			s['username']     = RoRclient.find("./user").get("name", s['username'])
+			s['usertoken']    = RoRclient.find("./user").get("token", s['usertoken'])
+			s['userlanguage'] = RoRclient.find("./user").get("language", s['userlanguage'])
 
 		# if an element <admins> exists
 		if not RoRclient.find("./admins") is None:
 			admins = RoRclient.find("./admins")
 			for admin in admins:
-				username = admin.get("username", default="")
+				username = admin.get("username", "")
 				if len(username.strip())==0:
 					self.logger.error("Every admin element should have a username attribute!")
 					continue
 				else:
 					s['admins'][username] = { 'username': username }
 
-				tmp = admin.get("password", default="")
+				tmp = admin.get("password", "")
 				if len(tmp.strip())==0:
 					self.logger.error("Admin '%s' should have a password!", username)
 					del s['admins'][username]
@@ -396,7 +406,7 @@ class Config:
 		if not RoRclient.find("./announcements") is None:
 			announcements = RoRclient.find("./announcements")
 			
-			s['announcementsDelay'] = int(announcements.get("delay", default=s['announcementsDelay']))
+			s['announcementsDelay'] = int(announcements.get("delay", s['announcementsDelay']))
 			
 			counter = 0
 			for announcement in announcements:
@@ -460,7 +470,14 @@ class main:
 		self.runCondition = True
 		self.restarting   = False
 	
-		logging.basicConfig(filename='RoRservices.log',level=logging.DEBUG,format="%(asctime)s|%(name)-12s|%(levelname)-8s| %(message)s",filemode="w")
+		# Every received and sent message is logged at debug level, so the records are
+		# buffered and written in batches. Warnings and errors flush the buffer right away,
+		# stayAlive() flushes it every LOG_FLUSH_INTERVAL seconds.
+		logHandler = logging.FileHandler('RoRservices.log', mode="w")
+		logHandler.setFormatter(logging.Formatter("%(asctime)s|%(name)-12s|%(levelname)-8s| %(message)s"))
+		self.logBuffer = logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, logging.WARNING, logHandler)
+		logging.getLogger().addHandler(self.logBuffer)
+		logging.getLogger().setLevel(logging.DEBUG)
 		self.logger = logging.getLogger('main')
 		self.logger.info('LOG STARTED')
 		
@@ -556,7 +573,11 @@ class main:
 				killCounter += 1
 		if killCounter > 0:
 			self.logger.info("   - Waiting for RoRclients to disconnect...")
-			time.sleep(6)
+			# they disconnect in parallel, so they share one deadline
+			deadline = time.time() + 6
+			for ID in self.RoRclients:
+				if self.RoRclients[ID].is_alive():
+					self.RoRclients[ID].join(max(0, deadline - time.time()))
 		else:
 			self.logger.error("   x Found no RoRclients running...")
 		
@@ -566,7 +587,7 @@ class main:
 				self.messageIRCclient(("disconnect", "restarting on request"))
 			else:
 				self.messageIRCclient(("disconnect", "Shutting down on request"))
-			time.sleep(1)
+			self.IRC_bot.join(1)
 		else:
 			self.logger.error("   x Found no IRC client running...")
 		
@@ -581,6 +602,7 @@ class main:
 		sys.exit(0)
 	
 	def stayAlive(self):
+		lastLogFlush = time.time()
 		try:
 			while self.runCondition:
 				#time.sleep( 1 )
@@ -601,10 +623,15 @@ class main:
 						# self.logger.warning("queue is full")
 						# continue
 						
+				# write out the buffered log records, so they don't get lost if we're killed
+				if time.time() - lastLogFlush >= LOG_FLUSH_INTERVAL:
+					self.logBuffer.flush()
+					lastLogFlush = time.time()
+
 				try:
-					response = self.queue_to_main.get()
+					response = self.queue_to_main.get(True, LOG_FLUSH_INTERVAL)
 				except Queue.Empty:
-					self.logger.error("Main queue timed out.")
+					continue
 				else:
 					if response[0] == "IRC":
 						if response[1] == "connect_success":